@@ -2,167 +2,513 @@
 # Это приложение позволяет пользователям инициировать и контролировать диалоги между двумя персонажами,
 # основанные на темах и описаниях ролей, с интеграцией модели llama_cpp для генерации ответов.
 
+import eventlet  # Кооперативный ввод-вывод для SocketIO (должен быть импортирован и применен до остальных модулей)
+eventlet.monkey_patch()
+from eventlet import tpool  # Пул настоящих потоков ОС для блокирующих вызовов модели
+
 from flask import Flask, render_template, request  # Flask для веб-фреймворка, render_template для шаблонов, request для SID
 from flask_socketio import SocketIO, emit  # SocketIO для realtime коммуникации, emit для отправки сообщений
 import time  # Для временных задержек и таймстампов
+import codecs  # Для инкрементального декодирования UTF-8 из байтов токенов
 import llama_cpp  # Библиотека для работы с LLM моделями (GGUF формат)
+from llama_cpp.llama_speculative import LlamaDraftModel  # Интерфейс черновой модели для спекулятивного декодирования
+import numpy as np  # Для массива черновых токенов, который ожидает llama_cpp
 import os  # Для работы с файловой системой
-import ssl  # Для настройки HTTPS
-import GPUtil  # Для мониторинга GPU
-import threading  # Для многопоточности (лок, потоки)
+import pynvml  # Для мониторинга GPU через NVML (без запуска nvidia-smi)
+import atexit  # Для завершения работы NVML при выходе
+import threading  # Для событий остановки диалогов
+import queue  # Для очереди диалогов, ожидающих модель
+import collections  # Для ограниченной истории реплик (deque)
 import logging  # Для логирования событий и ошибок
+import json  # Для метаданных диалога в сохраняемых файлах
+import functools  # Для кэширования токенизированных префиксов промпта
+import httpx  # HTTP-клиент для llama-server (режим непрерывного батчинга)
 
 # Настройка логирования для отладки и мониторинга
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Инициализация Flask app и SocketIO с включенными CORS для всех доменов (для демонстрации; в продакшене ограничить)
+# Инициализация NVML и дескриптор первого GPU (None, если GPU или драйвер NVIDIA недоступны)
+try:
+    pynvml.nvmlInit()
+    atexit.register(pynvml.nvmlShutdown)
+    gpu_handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+except pynvml.NVMLError as e:
+    logging.warning(f"NVML недоступен, мониторинг GPU отключен: {e}")
+    gpu_handle = None
+
+# Инициализация Flask app и SocketIO с включенными CORS для всех доменов (для демонстрации; в продакшене ограничить).
+# Режим eventlet обслуживает соединения зелеными потоками вместо потока ОС на каждое соединение
 app = Flask(__name__)
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, async_mode='eventlet', cors_allowed_origins="*")
 
 # Глобальная переменная для загруженной модели LLM
 model = None
 
-# Глобальный словарь для флагов остановки диалогов, ключ - SID пользователя, чтобы каждый мог останавливать только свой диалог
-stop_flags = {}
+# Адрес llama-server (например, http://127.0.0.1:8080). Если задан, модель в процессе не загружается:
+# реплики генерирует сервер, который с --parallel и --cont-batching объединяет запросы одновременных
+# диалогов в общие батчи на GPU. LLAMA_SERVER_PARALLEL - сколько диалогов выполняется одновременно
+LLAMA_SERVER_URL = os.environ.get('LLAMA_SERVER_URL')
+LLAMA_SERVER_PARALLEL = int(os.environ.get('LLAMA_SERVER_PARALLEL', 4))
+
+# HTTP-клиент для llama-server (только в режиме сервера). Таймаут чтения ограничивает ожидание
+# очередного фрагмента ответа, чтобы зависший запрос не занимал рабочую задачу навсегда
+llama_server = httpx.Client(base_url=LLAMA_SERVER_URL, timeout=httpx.Timeout(10.0, read=120.0)) if LLAMA_SERVER_URL else None
+
+# Глобальный словарь событий остановки диалогов, ключ - SID пользователя, чтобы каждый мог останавливать только свой диалог.
+# Диалог проверяет свой threading.Event, не обращаясь к словарю
+stop_events = {}
+
+# Сколько последних реплик попадает в промпт: ограничивает длину контекста, который вычисляет модель
+MAX_HISTORY_TURNS = 8
 
-# Глобальный словарь для хранения историй диалогов по SID (только текст, метаданные добавляются при сохранении)
-dialogs = {}
+# Последний статус GPU, полученный фоновой задачей update_gpu_status (ts - время проверки).
+# Обновляется только этой задачей заменой словаря целиком, поэтому читается без блокировки
+gpu_state = {'status': 'free', 'message': 'GPU свободен', 'ts': 0}
 
-# Блокировка для предотвращения одновременного запуска нескольких диалогов (глобальная очередь)
-dialog_lock = threading.Lock()
+# Ограниченная очередь диалогов, ожидающих модель: (SID, данные запроса, событие остановки).
+# Диалоги выполняются по одному в порядке поступления; при переполнении новые запросы отклоняются
+gen_queue = queue.Queue(maxsize=16)
 
 def check_gpu_status():
     """
     Проверяет статус первого GPU и возвращает строку: 'free', 'busy', 'no_gpu' или 'error'.
     Использует загрузку GPU > 80% как критерий занятости.
+    Загрузка читается через NVML в том же процессе, без запуска nvidia-smi.
     """
+    if gpu_handle is None:
+        return 'no_gpu'
     try:
-        gpus = GPUtil.getGPUs()
-        if not gpus:
-            return 'no_gpu'
-        # Проверяем первую GPU
-        gpu = gpus[0]
+        util = pynvml.nvmlDeviceGetUtilizationRates(gpu_handle).gpu
         # Если загрузка процессоров > 80%, считаем GPU занятым
-        if gpu.load * 100 > 80:
+        if util > 80:
             return 'busy'
         else:
             return 'free'
+    except pynvml.NVMLError_NotFound:
+        return 'no_gpu'
     except Exception as e:
         print(f"Ошибка при проверке GPU: {e}")
         return 'error'
 
+class GemmaDraftModel(LlamaDraftModel):
+    """
+    Черновая модель для спекулятивного декодирования: маленькая модель семейства Gemma 3
+    жадно предлагает num_pred_tokens следующих токенов, а основная модель проверяет их
+    за один проход и принимает совпавшие. Токенизатор у моделей общий, поэтому
+    токены передаются без перекодирования.
+    """
+    def __init__(self, draft, num_pred_tokens=4):
+        self.draft = draft
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids, /, **kwargs):
+        draft_tokens = []
+        # generate переиспользует KV-кэш черновой модели для общего с прошлым вызовом префикса
+        for token in self.draft.generate(input_ids.tolist(), temp=0.0):
+            draft_tokens.append(token)
+            if len(draft_tokens) >= self.num_pred_tokens:
+                break
+        return np.array(draft_tokens, dtype=np.intc)
+
+# Контекст моделей при спекулятивном декодировании. С черновой моделью llama_cpp хранит логиты всех
+# позиций (logits_all): буфер n_ctx * n_vocab * 4 байт в ОЗУ, для словаря Gemma 3 (262144 токена)
+# при n_ctx=8192 это около 8 ГБ. При 2048 токенах буфер занимает около 2 ГБ
+DRAFT_N_CTX = 2048
+
+def load_draft_model():
+    """
+    Загружает черновую модель Gemma 3 1B для спекулятивного декодирования.
+    Возвращает GemmaDraftModel или None, если модель не найдена или не загрузилась:
+    тогда основная модель генерирует без черновика.
+    """
+    draft_path = r"G:\LLM_models2\gemma-3-1b-it-Q4_K_M.gguf"  # Путь к черновой модели GGUF
+    if not os.path.exists(draft_path):
+        logging.info(f"Черновая модель не найдена ({draft_path}), спекулятивное декодирование отключено")
+        return None
+    try:
+        draft = llama_cpp.Llama(
+            model_path=draft_path,
+            n_ctx=DRAFT_N_CTX,  # Контекст как у основной модели при спекулятивном декодировании
+            n_gpu_layers=-1,  # Все слои на GPU
+            flash_attn=True,
+            verbose=False
+        )
+        return GemmaDraftModel(draft, num_pred_tokens=4)
+    except Exception as e:
+        logging.error(f"Ошибка загрузки черновой модели: {e}")
+        return None
+
+def create_model(draft_model):
+    """
+    Создает основную модель llama_cpp; с черновой моделью draft_model (или без нее при None).
+    """
+    return llama_cpp.Llama(
+        model_path=r"G:\LLM_models2\Grok-3-reasoning-gemma3-12B-distilled-HF.Q4_K_M.gguf",  # Путь к модели GGUF (4-битная квантизация)
+        n_ctx=8192 if draft_model is None else DRAFT_N_CTX,  # Максимальный контекст (меньше с черновой моделью, см. DRAFT_N_CTX)
+        chat_format="gemma",  # Формат чата для Gemma
+        n_gpu_layers=-1,  # Все слои на GPU (Q4_K_M модели 12B целиком помещается в 24 ГБ), CPU-потоки не используются
+        offload_kqv=True,  # KV-кэш и операции внимания тоже на GPU
+        n_batch=512,  # Размер логического батча при вычислении промпта
+        n_ubatch=512,  # Размер физического батча (подбирается под GPU, например llama-optimus)
+        flash_attn=True,  # Flash Attention: слитое ядро внимания без матрицы внимания в памяти (нужен и для квантизации V-кэша)
+        type_k=llama_cpp.GGML_TYPE_Q8_0,  # 8-битный K-кэш вдвое снижает объем чтения KV
+        type_v=llama_cpp.GGML_TYPE_Q8_0,  # 8-битный V-кэш
+        temperature=0.7,  # Температура генерации
+        max_tokens=8192,  # Максимум токенов в ответе
+        draft_model=draft_model,  # Черновая модель для спекулятивного декодирования (или None)
+        # Черновые токены проверяются по логитам всех позиций батча, поэтому с черновой моделью
+        # llama_cpp нужен logits_all (без него буфер логитов рассчитан только на n_batch позиций)
+        logits_all=draft_model is not None,
+        verbose=False  # Отключить подробный вывод
+    )
+
 def load_model():
     """
     Загружает модель LLM с использованием llama_cpp, если она еще не загружена.
     Возвращает объект модели или None в случае ошибки.
     Данный пример тестировался с локальной моделью Grok-3-reasoning-gemma3.
     При тестировании использовалась бытовая видеокарта RTX 3090ti.
-    Время на генерацию ответа составляло 8-17 сек.
+    Время на генерацию ответа составляло 8-17 сек с квантизацией Q8_0.
+    Декодирование ограничено пропускной способностью памяти GPU, поэтому используется
+    квантизация Q4_K_M: вдвое меньше байт весов на каждый токен. Сравнить скорость
+    вариантов квантизации можно утилитой llama-bench из состава llama.cpp.
     Это дает представление о возможности использовать LLM в закрытом контуре
     с использованием чувствительных данных.
     """
     global model
     if model is None:
+        draft_model = load_draft_model()
+        if draft_model is not None:
+            try:
+                model = create_model(draft_model)
+                return model
+            except Exception as e:
+                # Чаще всего не хватает ОЗУ под буфер логитов: без черновой модели он не нужен
+                logging.error(f"Ошибка загрузки модели с черновой моделью, загрузка без нее: {e}")
         try:
-            model = llama_cpp.Llama(
-                model_path=r"G:\LLM_models2\Grok-3-reasoning-gemma3-12B-distilled-HF.Q8_0.gguf",  # Путь к модели GGUF
-                n_ctx=8192,  # Максимальный контекст
-                chat_format="gemma",  # Формат чата для Gemma
-                n_threads=4,  # Количество CPU потоков
-                n_gpu_layers=47,  # Количество слоев на GPU (снижено для стабильности)
-                temperature=0.7,  # Температура генерации
-                max_tokens=8192,  # Максимум токенов в ответе
-                verbose=False  # Отключить подробный вывод
-            )
-
+            model = create_model(None)
         except Exception as e:
             logging.error(f"Ошибка загрузки модели: {e}")
             model = None
     return model
 
-# Загрузка модели при запуске приложения
-load_model()
+# Загрузка модели при запуске приложения (в режиме llama-server модель загружена сервером)
+if not LLAMA_SERVER_URL:
+    load_model()
 
-def save_dialog_to_file(sid, dialog_history, topic, role1_name, role1_description, role2_name, role2_description):
+def open_dialog_log(sid, topic, role1_name, role1_description, role2_name, role2_description, num_steps):
     """
-    Сохраняет историю диалога с метаданными в файл в папке logs.
+    Открывает файл лога диалога в папке logs и сразу записывает в него метаданные.
     Файл имеет имя: dialog_{sid}_{timestamp}.txt
-    Включает тему, роли, описание ролей, количество шагов и время.
+    Метаданные (тема, роли, описание ролей, запрошенное количество шагов и время) записываются
+    одной строкой JSON после заголовка, чтобы их можно было разобрать одним json.loads.
+    Реплики дописываются в файл по мере генерации (write_dialog_line), поэтому история
+    не хранится в памяти. Возвращает открытый файл или None при ошибке.
     """
     os.makedirs('logs', exist_ok=True)
     timestamp = int(time.time())
     filename = f"logs/dialog_{sid}_{timestamp}.txt"
     try:
-        # Добавляем метаданные в начало файла
-        metadata = f"""=== Метаданные диалога ===
-SID: {sid}
-Тема диалога: {topic}
-Роль 1: {role1_name}
-Описание роли 1: {role1_description}
-Роль 2: {role2_name}
-Описание роли 2: {role2_description}
-Количество шагов: {len([line for line in dialog_history.split('\n') if line.strip() and ':' in line]) // 2} (примерно)
-Время создания: {time.strftime('%Y-%m-%d %H:%M:%S')}
-=== История диалога ===
-
-{dialog_history}
-"""
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write(metadata)
-        logging.info(f"Диалог для SID {sid} сохранён в файл {filename} с метаданными (тема: {topic}, роли: {role1_name}, {role2_name})")
+        metadata = json.dumps({
+            'sid': sid,
+            'topic': topic,
+            'role1_name': role1_name,
+            'role1_description': role1_description,
+            'role2_name': role2_name,
+            'role2_description': role2_description,
+            'num_steps': num_steps,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+        }, ensure_ascii=False)
+        log_file = open(filename, 'w', encoding='utf-8', buffering=1 << 16)
+        log_file.writelines(["=== Метаданные диалога ===\n", metadata, "\n=== История диалога ===\n\n"])
+        log_file.flush()
+        logging.info(f"Лог диалога для SID {sid} открыт: {filename} (тема: {topic}, роли: {role1_name}, {role2_name})")
+        return log_file
+    except Exception as e:
+        logging.error(f"Ошибка открытия лога диалога для SID {sid}: {e}")
+        return None
+
+def write_dialog_line(log_file, line):
+    """
+    Дописывает реплику в лог диалога. Сброс после каждой реплики сохраняет
+    уже сгенерированную часть диалога при падении процесса.
+    """
+    if log_file is None:
+        return
+    try:
+        log_file.write(f"{line}\n")
+        log_file.flush()
+    except Exception as e:
+        logging.error(f"Ошибка записи в лог диалога {log_file.name}: {e}")
+
+def close_dialog_log(sid, log_file, steps, status):
+    """
+    Записывает итог диалога (фактическое количество шагов и статус одной строкой JSON) и закрывает лог.
+    """
+    if log_file is None:
+        return
+    try:
+        log_file.writelines(["\n=== Итог диалога ===\n", json.dumps({'steps': steps, 'status': status}), "\n"])
+        log_file.close()
+        logging.info(f"Диалог для SID {sid} сохранён в файл {log_file.name} (шагов: {steps}, статус: {status})")
     except Exception as e:
         logging.error(f"Ошибка сохранения диалога для SID {sid}: {e}")
 
-def update_gpu_status(app_instance, sock):
+def update_gpu_status(sock):
     """
-    Фоновая функция для периодической проверки статуса GPU и отправки обновлений клиентам через SocketIO.
-    Запускается в отдельном потоке, обновляет каждые 5 секунд.
+    Фоновая задача для периодической проверки статуса GPU и отправки обновлений клиентам через SocketIO.
+    Проверяет статус каждые 5 секунд и сохраняет его в gpu_state, но рассылает только при изменении.
+    Ожидание через sock.sleep уступает управление циклу событий SocketIO.
     """
+    global gpu_state
+    last_status = None
     while True:
         status = check_gpu_status()
         message = {
             'busy': "GPU занят",
             'free': "GPU свободен"
         }.get(status, "Отсутствует GPU или ошибка")
-        with app_instance.app_context():
-            sock.emit('gpu_status', {'status': status, 'message': message})
-        time.sleep(5)  # Проверка каждые 5 секунд
+        gpu_state = {'status': status, 'message': message, 'ts': time.time()}
+        if status != last_status:
+            sock.emit('gpu_status', gpu_state)
+            last_status = status
+        sock.sleep(5)  # Проверка каждые 5 секунд
 
-# Запуск фонового потока для обновления статуса GPU
-status_thread = threading.Thread(target=update_gpu_status, args=(app, socketio), daemon=True)
-status_thread.start()
+# Запуск фоновой задачи для обновления статуса GPU
+socketio.start_background_task(update_gpu_status, socketio)
 
-def generate_response(topic, personality_description, conversation_history, max_tokens=300):
+def build_prompt_prefix(topic, role1_name, role1_description, role2_name, role2_description):
+    """
+    Строит неизменную часть промпта диалога: тему и описания обеих ролей.
+    Префикс одинаков для обоих участников и всех шагов, поэтому промпты соседних шагов
+    отличаются только дописанными в конец репликами и KV-кэш префикса переиспользуется.
     """
-    Генерирует ответ от имени персонажа с использованием LLM.
-    Строит промпт на основе темы, роли и истории.
-    В случае ошибки или пустого ответа использует резервный промпт.
-    Возвращает строку ответа или сообщение об ошибке.
+    return (
+        f"<start_of_turn>user\nТема диалога: {topic}\n\n"
+        f"Участник {role1_name}: {role1_description.strip()}\n\n"
+        f"Участник {role2_name}: {role2_description.strip()}\n\n"
+        "Продолжите диалог участников. Каждая реплика — одно короткое предложение от имени говорящего, "
+        "кратко и соответствуя его роли.\n<end_of_turn>\n<start_of_turn>model\n"
+    )
+
+def tokenize(text, add_bos=False):
+    """
+    Токенизирует текст загруженной моделью, распознавая служебные токены Gemma (<start_of_turn> и т.п.).
+    """
+    return model.tokenize(text.encode('utf-8'), add_bos=add_bos, special=True)
+
+@functools.lru_cache(maxsize=32)
+def get_prefix_tokens(topic, role1_name, role1_description, role2_name, role2_description):
+    """
+    Возвращает кортеж токенов префикса промпта для темы и ролей диалога.
+    Результат кэшируется: повторные диалоги с теми же параметрами (например, с настройками
+    формы по умолчанию) не строят и не токенизируют префикс заново, а совпадающий префикс
+    в KV-кэше модели переиспользуется без повторного вычисления.
+    """
+    prompt_prefix = build_prompt_prefix(topic, role1_name, role1_description, role2_name, role2_description)
+    return tuple(tokenize(prompt_prefix, add_bos=True))
+
+def context_fits(prefix_tokens, history, header_tokens, max_tokens=80):
+    """
+    Проверяет, что промпт реплики (префикс, окно истории и заголовок) вместе с max_tokens токенов
+    ответа помещается в контекст модели: с черновой моделью он уменьшен до DRAFT_N_CTX.
+    """
+    return len(prefix_tokens) + sum(len(turn) for turn in history) + len(header_tokens) + max_tokens <= model.n_ctx()
+
+def generate_response(prefix_tokens, history, header_tokens, personality_description, topic, stop, max_tokens=80):
+    """
+    Генерирует ответ от имени персонажа в потоковом режиме. prefix_tokens - токены префикса промпта,
+    history - deque последних реплик в виде токенов (сгенерированная реплика добавляется в него),
+    header_tokens - токены заголовка реплики ("Имя:"), stop - стоп-последовательности ("Имя:").
+    Это генератор: выдает фрагменты ответа, а итоговую строку (или сообщение об ошибке) возвращает через return.
     """
     global model
     if model is None:
         return "Ошибка: Модель не загружена."
     try:
-        prompt = f"<start_of_turn>user\nТема диалога: {topic}\n\nВаша роль: {personality_description}\n\nИстория диалога (предыдущие реплики):\n{conversation_history}\n\nТеперь ваша очередь. Сгенерируйте одну реплику от своего имени, кратко и соответствуя роли. Не превышайте одно предложение.\n<end_of_turn>\n<start_of_turn>model\n"
-
-        output = model(
-            prompt,
-            max_tokens=max_tokens,
-            stop=["<end_of_turn>", "\n\n", "\n", "Ученый:", "Студент:"],
-            echo=False
-        )
-        response = output.get("choices", [{}])[0].get("text", "").strip()
-
-        if not response or len(response) < 5:
+        # Контекст собирается заново на каждом шаге; model.generate сравнивает его с токенами в KV-кэше
+        # и вычисляет только несовпадающий хвост: заголовок новой реплики, а когда из окна истории
+        # выпадает старая реплика или сменился диалог - реплики после префикса
+        context = list(prefix_tokens)
+        for turn in history:
+            context.extend(turn)
+        turn_start = len(context)
+        context.extend(header_tokens)
+        reply_start = len(context)
+
+        stop_tokens = {model.token_eos(), *tokenize("<end_of_turn>")}
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')  # Токен может содержать часть символа
+        response = ""
+        sent = 0  # Длина уже отправленной части ответа
+        # Хвост ответа такой длины может оказаться началом стоп-последовательности и придерживается
+        hold = max((len(text) for text in stop), default=1) - 1
+        line_closed = False
+        # С черновой моделью generate проверяет предложенные ею токены пачками (спекулятивное декодирование)
+        for token in model.generate(context, temp=0.7):
+            if token in stop_tokens:
+                break
+            context.append(token)
+            delta = decoder.decode(model.detokenize([token]))
+            if "\n" in delta:
+                # Перевод строки завершает реплику и остается в контексте как разделитель
+                delta = delta.split("\n", 1)[0]
+                line_closed = True
+            response += delta
+            cut = min((response.find(text) for text in stop if text in response), default=-1)
+            if cut != -1:
+                # Модель начала реплику за участника: обрезаем ответ и его токены по стоп-последовательности
+                response = response[:cut]
+                del context[reply_start:]
+                context.extend(tokenize(f" {response.strip()}\n"))
+                line_closed = True
+            # Реплика в одно предложение укладывается в max_tokens, а декодирование - основная часть времени ответа
+            if line_closed or len(context) - reply_start >= max_tokens:
+                break
+            # Отправка начинается с 5 символов: более короткий ответ заменяется резервным и не должен дойти до клиента
+            safe = len(response) - hold
+            if safe > sent and len(response[:safe].strip()) >= 5:
+                yield response[sent:safe]
+                sent = safe
+        if not line_closed:
+            context.extend(tokenize("\n"))
+
+        if len(response.strip()) >= 5:
+            if len(response) > sent:
+                yield response[sent:]  # Остаток ответа после завершения реплики уже не содержит стоп-последовательностей
+        else:
+            # Пустой или слишком короткий ответ заменяется ответом по резервному промпту
             prompt_retry = f"<start_of_turn>user\n{personality_description}. Ответь на тему '{topic}' одной репликой.\n<end_of_turn>\n<start_of_turn>model\n"
-            output = model(prompt_retry, max_tokens=100, stop=["<end_of_turn>", "\n"], echo=False)
-            response = output.get("choices", [{}])[0].get("text", "").strip()
-
+            response = ""
+            for chunk in model(prompt_retry, max_tokens=max_tokens, stop=["<end_of_turn>", "\n", *stop], echo=False, stream=True):
+                delta = chunk["choices"][0]["text"]
+                response += delta
+                yield delta
+            # Заменяем в контексте неудачную реплику на полученную по резервному промпту
+            del context[reply_start:]
+            context.extend(tokenize(f" {response.strip()}\n"))
+
+        history.append(context[turn_start:])
         return response.strip()
     except Exception as e:
         logging.error(f"Ошибка генерации ответа: {e}")
         return "Ошибка: Не удалось сгенерировать ответ."
 
+def stream_completion(prompt, stop, max_tokens):
+    """
+    Потоково генерирует продолжение prompt через /completion llama-server и выдает его фрагменты.
+    cache_prompt переиспользует KV-кэш общего с прошлым запросом префикса в слоте сервера.
+    """
+    with llama_server.stream('POST', '/completion', json={
+        'prompt': prompt,
+        'n_predict': max_tokens,
+        'temperature': 0.7,
+        'stop': ["<end_of_turn>", "\n", *stop],
+        'stream': True,
+        'cache_prompt': True
+    }) as r:
+        r.raise_for_status()
+        # Ответ приходит событиями SSE: строки "data: {json}" с очередным фрагментом в content
+        for line in r.iter_lines():
+            if not line.startswith('data: '):
+                continue
+            chunk = json.loads(line[len('data: '):])
+            delta = chunk.get('content', '')
+            if delta:
+                yield delta
+            if chunk.get('stop'):
+                break
+
+def generate_response_remote(prompt_prefix, history, header, personality_description, topic, stop, max_tokens=80):
+    """
+    Генерирует ответ через llama-server в потоковом режиме; аналог generate_response для режима сервера.
+    prompt_prefix - текст префикса промпта, history - deque последних реплик в виде текста,
+    header - заголовок реплики говорящего ("Имя:"). Сгенерированная реплика добавляется в history.
+    Это генератор: выдает фрагменты ответа, а итоговую строку (или сообщение об ошибке) возвращает через return.
+    В случае пустого ответа использует резервный промпт.
+    """
+    try:
+        response = ""
+        sent = 0  # Длина уже отправленной части ответа
+        for delta in stream_completion(prompt_prefix + "".join(history) + header, stop, max_tokens):
+            response += delta
+            # Как и в generate_response, ответ короче 5 символов до клиента не отправляется
+            if len(response.strip()) >= 5:
+                yield response[sent:]
+                sent = len(response)
+        response = response.strip()
+
+        if len(response) < 5:
+            prompt_retry = f"<start_of_turn>user\n{personality_description}. Ответь на тему '{topic}' одной репликой.\n<end_of_turn>\n<start_of_turn>model\n"
+            response = ""
+            for delta in stream_completion(prompt_retry, stop, max_tokens):
+                response += delta
+                yield delta
+            response = response.strip()
+    except Exception as e:
+        logging.error(f"Ошибка генерации ответа через llama-server: {e}")
+        return "Ошибка: Не удалось сгенерировать ответ."
+
+    history.append(f"{header} {response}\n")
+    return response
+
+def emit_queue_positions():
+    """
+    Отправляет каждому диалогу в очереди его текущую позицию (1 - следующий на выполнение).
+    """
+    # После monkey_patch очередь зеленая и без mutex: зеленые потоки кооперативны,
+    # поэтому снимок очереди берется без блокировки
+    waiting = list(gen_queue.queue)
+    for position, (sid, _, _) in enumerate(waiting, start=1):
+        socketio.emit('dialog_queued', {'status': 'queued', 'position': position}, to=sid)
+
+def cancel_dialog(sid):
+    """
+    Останавливает диалог пользователя с указанным SID: выполняющийся прерывается на ближайшем
+    фрагменте ответа, а ожидающий удаляется из очереди и освобождает в ней место.
+    dialog_stopped ожидающему диалогу отправляется здесь, выполняющемуся - из run_dialog.
+    """
+    stop_event = stop_events.get(sid)
+    if stop_event is None:
+        return
+    stop_event.set()
+    queued = [item for item in gen_queue.queue if item[2] is stop_event]
+    for item in queued:
+        gen_queue.queue.remove(item)
+    if queued:
+        stop_events.pop(sid, None)
+        socketio.emit('dialog_stopped', {'steps': 0}, to=sid)
+        emit_queue_positions()
+
+def dialog_worker():
+    """
+    Рабочая задача модели: берет диалоги из очереди gen_queue в порядке поступления и выполняет их.
+    С моделью в процессе такая задача одна, поэтому диалоги выполняются строго по одному;
+    в режиме llama-server задач LLAMA_SERVER_PARALLEL и сервер батчит их запросы.
+    После взятия очередного диалога сообщает ожидающим их новые позиции.
+    Диалоги, остановленные пользователем еще в очереди, пропускаются.
+    """
+    while True:
+        sid, data, stop_event = gen_queue.get()
+        try:
+            emit_queue_positions()
+            if stop_event.is_set():
+                logging.info(f"Диалог остановлен до начала генерации: SID {sid}")
+                if stop_events.get(sid) is stop_event:
+                    stop_events.pop(sid, None)
+                socketio.emit('dialog_stopped', {'steps': 0}, to=sid)
+                continue
+            run_dialog(sid, data, stop_event)
+        except Exception as e:
+            logging.error(f"Ошибка выполнения диалога для SID {sid}: {e}")
+            # Событие освобождается и здесь: исключение могло возникнуть до try/finally в run_dialog
+            if stop_events.get(sid) is stop_event:
+                stop_events.pop(sid, None)
+            socketio.emit('dialog_error', {'message': 'Ошибка: Не удалось выполнить диалог.'}, to=sid)
+
+# Запуск рабочих задач модели
+for _ in range(LLAMA_SERVER_PARALLEL if LLAMA_SERVER_URL else 1):
+    socketio.start_background_task(dialog_worker)
+
 # Главный маршрут приложения, возвращает HTML шаблон
 @app.route('/')
 def index():
@@ -173,39 +519,66 @@ def index():
 def handle_connect():
     sid = request.sid
     logging.info(f"Пользователь подключился: SID {sid}")
-    # Отправляет текущий статус GPU при подключении
-    status = check_gpu_status()
-    message = {
-        'busy': "GPU занят",
-        'free': "GPU свободен"
-    }.get(status, "Отсутствует GPU или ошибка")
-    emit('gpu_status', {'status': status, 'message': message})
+    # Отправляет последний статус GPU из фоновой проверки, не опрашивая GPU при каждом подключении
+    emit('gpu_status', gpu_state)
+
+# Обработчик отключения клиента: диалог закрытой вкладки больше никому не нужен
+@socketio.on('disconnect')
+def handle_disconnect():
+    sid = request.sid
+    logging.info(f"Пользователь отключился: SID {sid}")
+    cancel_dialog(sid)
 
 # Обработчик остановки диалога
 @socketio.on('stop_dialog')
 def handle_stop_dialog():
     sid = request.sid
     logging.info(f"Пользователь остановил диалог: SID {sid}")
-    stop_flags[sid] = True
-    # Для сохранения диалога вызывается в handle_start_dialog при завершении
-    emit('dialog_stopped', to=sid)
+    # dialog_stopped отправляется, когда диалог действительно остановлен (см. cancel_dialog),
+    # чтобы клиент не запустил новый диалог раньше, чем завершится текущий
+    cancel_dialog(sid)
 
 # Основной обработчик запуска диалога
 @socketio.on('start_dialog')
 def handle_start_dialog(data):
     sid = request.sid
     logging.info(f"Пользователь начал диалог: SID {sid}, тема: {data.get('topic', 'Не указана')}, роли: {data.get('role1_name', 'Не указана')}/{data.get('role2_name', 'Не указана')}, шагов: {data.get('num_steps', 'Не указана')}")
-    stop_flags[sid] = False  # Сбрасываем флаг остановки для этого SID
+    # Количество шагов проверяется до постановки в очередь, чтобы run_dialog не упал на разборе
+    try:
+        int(data.get('num_steps', 7))
+    except (TypeError, ValueError):
+        logging.warning(f"Некорректное количество шагов, запрос отклонен: SID {sid}, шагов: {data.get('num_steps')!r}")
+        emit('dialog_error', {'message': f"Ошибка: Некорректное количество шагов: {data.get('num_steps')!r}."}, to=sid)
+        return
 
-    # Инициализируем историю диалога для SID
-    dialogs[sid] = ""
+    # Пока диалог этого SID в очереди или выполняется, новый не принимается: иначе событие
+    # остановки заменилось бы и текущий диалог нельзя было бы остановить
+    previous = stop_events.get(sid)
+    if previous is not None and not previous.is_set():
+        logging.warning(f"Диалог уже запущен, запрос отклонен: SID {sid}")
+        emit('dialog_error', {'message': 'Ошибка: Диалог уже запущен. Остановите его или дождитесь завершения.'}, to=sid)
+        return
+
+    # Новое событие остановки для этого SID
+    stop_event = threading.Event()
+    stop_events[sid] = stop_event
 
-    # Пытаемся получить блокировку для запуска диалога
-    if not dialog_lock.acquire(blocking=False):
-        logging.warning(f"Диалог заблокирован другим пользователем: SID {sid}")
-        emit('dialog_error', {'message': 'Ошибка: Диалог уже запущен другим пользователем. Пожалуйста, подождите.'}, to=sid)
+    # Ставим диалог в очередь рабочей задачи модели, обработчик сразу возвращает управление SocketIO
+    try:
+        gen_queue.put_nowait((sid, data, stop_event))
+    except queue.Full:
+        logging.warning(f"Очередь диалогов заполнена, запрос отклонен: SID {sid}")
+        stop_events.pop(sid, None)
+        emit('queue_full', {'message': 'Ошибка: Очередь диалогов заполнена. Пожалуйста, попробуйте позже.'}, to=sid)
         return
+    emit('dialog_queued', {'status': 'queued', 'position': max(gen_queue.qsize(), 1)}, to=sid)
 
+def run_dialog(sid, data, stop_event):
+    """
+    Выполняет шаги диалога для пользователя с указанным SID и отправляет реплики клиенту.
+    stop_event - событие остановки этого диалога; реплики дописываются в лог диалога по мере генерации.
+    Вызывается рабочей задачей модели dialog_worker, когда подходит очередь диалога.
+    """
     # Извлекаем данные из запроса с дефолтами
     topic = data.get('topic', 'Спор о форме Земли')
     role1_name = data.get('role1_name', 'Иван')
@@ -222,17 +595,56 @@ def handle_start_dialog(data):
     ''')
     num_steps = int(data.get('num_steps', 7))
 
-    try:  # try-finally для гарантии освобождения блокировки
-        if model is None:
-            logging.error(f"Модель не загружена для SID {sid}")
-            emit('new_line', {'step': 0, 'line': 'Ошибка: Модель не загружена.'}, to=sid)
-            return
+    if model is None and not LLAMA_SERVER_URL:
+        logging.error(f"Модель не загружена для SID {sid}")
+        if stop_events.get(sid) is stop_event:
+            stop_events.pop(sid, None)
+        socketio.emit('dialog_error', {'message': 'Ошибка: Модель не загружена.'}, to=sid)
+        return
 
-        conversation_history = ""
+    log_file = open_dialog_log(sid, topic, role1_name, role1_description, role2_name, role2_description, num_steps)
+    steps_written = 0
+    status = 'error'  # Итог для лога, если диалог прервется исключением
+    try:
+        # Префикс промпта и заголовки реплик готовятся один раз на диалог, окно последних реплик - для промпта.
+        # Для модели в процессе это токены, для llama-server - текст (сервер токенизирует его сам)
+        if LLAMA_SERVER_URL:
+            prefix = build_prompt_prefix(topic, role1_name, role1_description, role2_name, role2_description)
+            encode = str
+            # HTTP-запросы к серверу кооперативны в eventlet и не блокируют цикл событий
+            generate = generate_response_remote
+        else:
+            prefix = get_prefix_tokens(topic, role1_name, role1_description, role2_name, role2_description)
+            encode = tokenize
+
+            def generate(*args):
+                # Генератор выполняется в потоке ОС через tpool, поэтому декодирование не блокирует
+                # цикл событий eventlet (в том числе stop_dialog)
+                return tpool.Proxy(generate_response(*args))
+        headers = {name: encode(f"{name}:") for name in (role1_name, role2_name)}
+        stop = [f"{role1_name}:", f"{role2_name}:"]
+        history = collections.deque(maxlen=MAX_HISTORY_TURNS)
+
+        # Первая реплика фиксирована и не требует LLM: отправляем ее сразу и кладем в историю промпта
+        step = 0
+        if num_steps >= 1:
+            step = 1
+            greeting = f"{role1_name}: Привет, давай поспорим?"
+            history.append(encode(f"{greeting}\n"))
+            write_dialog_line(log_file, greeting)
+            steps_written += 1
+            socketio.emit('waiting', {
+                'step': step,
+                'speaker': role1_name
+            }, to=sid)
+            socketio.emit('new_line', {
+                'step': step,
+                'line': greeting
+            }, to=sid)
 
-        # Цикл генерации шагов диалога
-        for step in range(1, num_steps + 1):
-            if stop_flags.get(sid, False):
+        # Цикл генерации остальных шагов диалога
+        for step in range(2, num_steps + 1):
+            if stop_event.is_set():
                 break
 
             # Определяем говорящего на основе шага (нечетный - роль1, четный - роль2)
@@ -243,79 +655,86 @@ def handle_start_dialog(data):
                 speaker = role2_name
                 personality = role2_description
 
+            # Тема и описания ролей вводятся свободно и могут не поместиться в контекст модели
+            # (llama-server проверяет контекст сам)
+            if not LLAMA_SERVER_URL and not context_fits(prefix, history, headers[speaker]):
+                logging.error(f"Промпт диалога не помещается в контекст модели ({model.n_ctx()} токенов): SID {sid}")
+                socketio.emit('dialog_error', {'message': 'Ошибка: Тема и описания ролей слишком длинные для контекста модели. Сократите их.'}, to=sid)
+                return
+
             # Отправляем сигнал ожидания клиенту
-            emit('waiting', {
+            socketio.emit('waiting', {
                 'step': step,
                 'speaker': speaker
             }, to=sid)
 
-            # Небольшая пауза для визуализации
-            time.sleep(0.3)
-
-            if stop_flags.get(sid, False):
-                break
-
-            # Фиксированная первая реплика без LLM
-            if step == 1 and speaker == role1_name:
-                response = "Привет, давай поспорим?"
-            else:
-                response = generate_response(topic, personality, conversation_history)
-
-            if stop_flags.get(sid, False):
+            # Пересылаем клиенту фрагменты ответа по мере генерации
+            stream = generate(prefix, history, headers[speaker], personality, topic, stop)
+            while True:
+                try:
+                    delta = next(stream)
+                except StopIteration as result:
+                    response = result.value
+                    break
+                if stop_event.is_set():
+                    stream.close()  # Прерываем декодирование, не дожидаясь конца реплики
+                    response = ""
+                    break
+                socketio.emit('token_delta', {'step': step, 'delta': delta}, to=sid)
+                socketio.sleep(0)  # Отдаем управление, чтобы фрагмент сразу ушел клиенту
+
+            if stop_event.is_set():
                 break
 
             # Добавляем реплику в историю
             new_line = f"{speaker}: {response}"
-            conversation_history += f"{new_line}\n"
-            dialogs[sid] += f"{new_line}\n"
+            write_dialog_line(log_file, new_line)
+            steps_written += 1
 
             # Отправляем новую реплику клиенту
-            emit('new_line', {
+            socketio.emit('new_line', {
                 'step': step,
                 'line': new_line
             }, to=sid)
 
-        # После цикла: если не остановлен, завершаем и сохраняем
-        if not stop_flags.get(sid, False):
+        # После цикла: сообщаем клиенту итог, лог закрывается в finally
+        if not stop_event.is_set():
             logging.info(f"Диалог завершён: SID {sid}, тема: {topic}, шагов: {step}")
-            save_dialog_to_file(sid, dialogs[sid], topic, role1_name, role1_description, role2_name, role2_description)
-            emit('dialog_completed', {'steps': step}, to=sid)
-            del dialogs[sid]  # Очистка памяти
+            socketio.emit('dialog_completed', {'steps': step}, to=sid)
+            status = 'completed'
         else:
             logging.info(f"Диалог остановлен: SID {sid}, тема: {topic}, шагов: {step}")
-            save_dialog_to_file(sid, dialogs[sid], topic, role1_name, role1_description, role2_name, role2_description)
-            emit('dialog_stopped', {'steps': step}, to=sid)
-            del dialogs[sid]  # Очистка памяти
-
+            socketio.emit('dialog_stopped', {'steps': step}, to=sid)
+            status = 'stopped'
     finally:
-        dialog_lock.release()  # Всегда освобождаем блокировку
+        # Диалог закрывает свой лог и освобождает событие остановки при любом исходе
+        if stop_events.get(sid) is stop_event:
+            stop_events.pop(sid, None)
+        close_dialog_log(sid, log_file, steps_written, status)
 
 # Запуск приложения в блоке __main__
 if __name__ == '__main__':
+    # В режиме eventlet socketio.run запускает сервер eventlet.wsgi (подходит и для продакшена)
     # Попытка запуска с SSL сертификатами (HTTPS на порту 443)
     if os.path.exists('cert.pem') and os.path.exists('key.pem'):
-        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        context.load_cert_chain('cert.pem', 'key.pem')
-
         socketio.run(
             app,
             host='0.0.0.0',
             port=443,  # Стандартный HTTPS порт
             debug=True,
-            ssl_context='adhoc',  # Автоматическое создание SSL
-            allow_unsafe_werkzeug=True
+            certfile='cert.pem',  # SSL сертификат
+            keyfile='key.pem'  # SSL ключ
         )
     else:
         # Фallback на HTTP без SSL
         print("SSL сертификаты не найдены. Запускаю в HTTP режиме.")
         print("Для HTTPS создайте сертификаты командой:")
         print("openssl req -x509 -newkey rsa:4096 -nodes -out cert.pem -keyout key.pem -days 365")
-        # Для продакшена можно использовать готовый SSL контекст, например: ('/path/to/fullchain.pem', '/path/to/privkey.pem')
+        # Для продакшена можно указать готовые сертификаты, например: certfile='/path/to/fullchain.pem', keyfile='/path/to/privkey.pem'
 
         socketio.run(
             app,
             host='0.0.0.0',
             port=5000,
-            debug=True,
-            allow_unsafe_werkzeug=True
+            debug=True
         )